@@ -1,9 +1,11 @@
-import collections, re
+import collections, heapq, operator, re
 from typing import Iterable, NamedTuple
-import nltk
 import json
 from tqdm import tqdm
 
+# Same pattern as nltk.wordpunct_tokenize, compiled once
+_WORDPUNCT_RE = re.compile(r"\w+|[^\w\s]+")
+
 
 class Tokenization(NamedTuple):
     tokens: Iterable[str]
@@ -27,16 +29,9 @@ class BytePairEncoding:
         UNK_TOKEN="<UNK>",
         PAD_TOKEN="<PAD>",
     ):
-        with open(corpus_path, encoding="utf-8") as f:
-            self.corpus = f.read()
-
-        if lower_case:
-            self.corpus = self.corpus.lower()
-
+        # The corpus is streamed from disk when building the vocab, never held in memory
+        self.corpus_path = corpus_path
         self.lower_case = lower_case
-        print(
-            f"Base corpus has {len(self.corpus)} characters with {len(set(self.corpus))} distinct."
-        )
 
         self.EOW_TOKEN = EOW_TOKEN
         self.UNK_TOKEN = UNK_TOKEN
@@ -46,107 +41,285 @@ class BytePairEncoding:
     def split_into_words_and_create_vocab(self):
         """
         Split text into list of words and add EOW token to each.
-        Create vocab of all words with their counts.
+        Create vocab of all words, as tuples of symbols, with their counts.
+
+        The corpus is read line by line, words never span a line break.
 
         Ex:
         >>> print(split_into_words_string('this is a test string!'))
-        {'t h i s </w>': 1, 'i s </w>': 1, 'a </w>': 1, 't e s t </w>': 1, 's t r i n g </w>': 1, '! </w>': 1}
+        {('t', 'h', 'i', 's', '</w>'): 1, ('i', 's', '</w>'): 1, ('a', '</w>'): 1, ('t', 'e', 's', 't', '</w>'): 1, ('s', 't', 'r', 'i', 'n', 'g', '</w>'): 1, ('!', '</w>'): 1}
 
         """
 
-        split_string = nltk.wordpunct_tokenize(self.corpus)
+        word_counts = collections.Counter()
+        num_chars = 0
+        distinct_chars = set()
+
+        with open(self.corpus_path, encoding="utf-8") as f:
+            for line in f:
+                if self.lower_case:
+                    line = line.lower()
 
-        vocab = collections.defaultdict(int)
-        for word in split_string:
-            vocab[" ".join(list(word) + [self.EOW_TOKEN])] += 1
+                num_chars += len(line)
+                distinct_chars.update(line)
+                word_counts.update(_WORDPUNCT_RE.findall(line))
+
+        print(
+            f"Base corpus has {num_chars} characters with {len(distinct_chars)} distinct."
+        )
+
+        # Only split each distinct word into symbols once
+        vocab = {
+            tuple(word) + (self.EOW_TOKEN,): count
+            for word, count in word_counts.items()
+        }
 
         return vocab
 
     # ---------- BPE Helper Functions ---------- #
     def count_pairs(self, vocab):
         """
-        From a vocabulary, count all pairs of symbols and return a sorted dict with all pair counts
+        From a vocabulary, count all pairs of symbols and return a Counter with all pair counts
 
         Ex:
-        >>> vocab = {'t h i s </w>': 1, 'i s </w>': 1, 'a </w>': 1, 't e s t </w>': 1, 's t r i n g </w>': 1, '! </w>': 1}
+        >>> vocab = {('t', 'h', 'i', 's', '</w>'): 1, ('i', 's', '</w>'): 1, ('a', '</w>'): 1, ('t', 'e', 's', 't', '</w>'): 1, ('s', 't', 'r', 'i', 'n', 'g', '</w>'): 1, ('!', '</w>'): 1}
         >>> print(count_pairs(vocab))
-        {('i', 's'): 2, ('s', '</w>'): 2, ('s', 't'): 2, ('t', 'h'): 1, ('h', 'i'): 1, ('a', '</w>'): 1, ('t', 'e'): 1, ('e', 's'): 1, ('t',
-        '</w>'): 1, ('t', 'r'): 1, ('r', 'i'): 1, ('i', 'n'): 1, ('n', 'g'): 1, ('g', '</w>'): 1, ('!', '</w>'): 1}
+        Counter({('i', 's'): 2, ('s', '</w>'): 2, ('s', 't'): 2, ('t', 'h'): 1, ('h', 'i'): 1, ('a', '</w>'): 1, ('t', 'e'): 1, ('e', 's'): 1, ('t',
+        '</w>'): 1, ('t', 'r'): 1, ('r', 'i'): 1, ('i', 'n'): 1, ('n', 'g'): 1, ('g', '</w>'): 1, ('!', '</w>'): 1})
         """
 
-        pairs = collections.defaultdict(int)
-        pairs_pattern = collections.defaultdict(int)
+        pairs_pattern = collections.Counter()
 
         for word, freq in vocab.items():
 
             # Iterate through each word and count pairs
-            for idx in range(len(word.split()) - 1):
-                pairs["".join(word.split()[idx] + word.split()[idx + 1])] += freq
-                pairs_pattern[(word.split()[idx], word.split()[idx + 1])] += freq
+            for a, b in zip(word, word[1:]):
+                pairs_pattern[(a, b)] += freq
 
-        return dict(sorted(pairs_pattern.items(), key=lambda x: x[1], reverse=True))
+        return pairs_pattern
 
     def perform_merge(self, vocab, pairs_pattern):
         """
-        From a (possibly merged) vocabulary, perform a merge on the given pattern
+        From a (possibly merged) vocabulary, perform a merge on the most frequent pattern
 
         Ex:
-        >>> vocab = {'t h i s </w>': 1, 'i s </w>': 1, 'a </w>': 1, 't e s t </w>': 1, 's t r i n g </w>': 1, '! </w>': 1}
+        >>> vocab = {('t', 'h', 'i', 's', '</w>'): 1, ('i', 's', '</w>'): 1, ('a', '</w>'): 1, ('t', 'e', 's', 't', '</w>'): 1, ('s', 't', 'r', 'i', 'n', 'g', '</w>'): 1, ('!', '</w>'): 1}
         >>> pairs_pattern = {('i', 's'): 2, ('s', '</w>'): 2, ('s', 't'): 2, ('t', 'h'): 1, ('h', 'i'): 1, ('a', '</w>'): 1, ('t', 'e'): 1, ('e', 's'): 1, ('t', '</w>'): 1, ('t', 'r'): 1, ('r', 'i'): 1, ('i', 'n'): 1, ('n', 'g'): 1, ('g', '</w>'): 1, ('!', '</w>'): 1}
         >>> print(perform_merge(vocab, pairs_pattern))
-        {'t h is </w>': 1, 'is </w>': 1, 'a </w>': 1, 't e s t </w>': 1, 's t r i n g </w>': 1, '! </w>': 1}
+        {('t', 'h', 'is', '</w>'): 1, ('is', '</w>'): 1, ('a', '</w>'): 1, ('t', 'e', 's', 't', '</w>'): 1, ('s', 't', 'r', 'i', 'n', 'g', '</w>'): 1, ('!', '</w>'): 1}
         """
 
         if len(pairs_pattern.keys()) == 0:
             return vocab, None
 
         else:
-            pattern_find = list(pairs_pattern.keys())[0]
-
-            pattern_A = pattern_find[0]
-            pattern_B = pattern_find[1]
-
-            bigram = " ".join([pattern_A, pattern_B])
+            # Only the top pair is needed. On ties, max keeps the first pair counted.
+            pattern_find, _ = max(pairs_pattern.items(), key=operator.itemgetter(1))
 
-            pattern = "".join([pattern_A, pattern_B])
+            pattern = "".join(pattern_find)
 
             merged_vocab = collections.defaultdict(int)
 
-            # This regex case here is weird... had to look at the paper for the negative lookbehinds.
-            # Without this, for example, the merge rule ('e','l') would produce 'el','del','rel'
-            regex_pattern = re.compile(r"(?<!\S)" + re.escape(bigram) + r"(?!\S)")
-
+            # Symbols are already discrete, so merging is a plain scan over each word.
+            # No lookarounds needed to stop the rule ('e','l') from producing 'del','rel'
             for word, freq in vocab.items():
 
-                repl = re.sub(regex_pattern, pattern, word)
-                merged_vocab[repl] += freq
+                # Most words don't contain the pair; a C-level membership test skips them
+                if pattern_find[0] in word:
+                    word = tuple(self.merge_symbols(word, pattern_find))
+                merged_vocab[word] += freq
 
             return merged_vocab, pattern
 
+    def merge_symbols(self, symbols, pair, merged_symbol=None):
+        """
+        Merge every occurrence of pair in a list of symbols, scanning left to right.
+        The merged symbol defaults to the concatenation of the pair.
+
+        Ex:
+        >>> print(merge_symbols(['t', 'h', 'i', 's', '</w>'], ('i', 's')))
+        ['t', 'h', 'is', '</w>']
+        """
+
+        pattern_A, pattern_B = pair
+        if merged_symbol is None:
+            merged_symbol = pattern_A + pattern_B
+
+        merged = []
+        idx = 0
+        while idx < len(symbols):
+            if (
+                idx < len(symbols) - 1
+                and symbols[idx] == pattern_A
+                and symbols[idx + 1] == pattern_B
+            ):
+                merged.append(merged_symbol)
+                idx += 2
+            else:
+                merged.append(symbols[idx])
+                idx += 1
+
+        return merged
+
+    def update_pair_counts(
+        self, word_id, old_symbols, new_symbols, freq, pair_counts, pair_to_words
+    ):
+        """
+        Move the pair counts of one word from old_symbols to new_symbols and keep the
+        pair -> word ids index in sync. Pairs whose count drops to zero are removed.
+        Returns the pairs whose count changed.
+        """
+
+        old_pairs = collections.Counter(zip(old_symbols, old_symbols[1:]))
+        new_pairs = collections.Counter(zip(new_symbols, new_symbols[1:]))
+
+        changed = []
+        for pair in old_pairs.keys() | new_pairs.keys():
+            change = new_pairs[pair] - old_pairs[pair]
+            if change == 0:
+                continue
+
+            changed.append(pair)
+            pair_counts[pair] += change * freq
+
+            if not old_pairs[pair]:
+                pair_to_words[pair].add(word_id)
+            elif not new_pairs[pair]:
+                pair_to_words[pair].discard(word_id)
+                if not pair_to_words[pair]:
+                    del pair_to_words[pair]
+                    del pair_counts[pair]
+
+        return changed
+
+    def first_occurrence(self, pair, words, pair_to_words, id2sym):
+        """
+        Return (word id, character offset) of the first occurrence of pair when reading
+        the words in order. Character offsets, unlike symbol indices, don't move when
+        other pairs in the word get merged.
+        """
+
+        word_id = min(pair_to_words[pair])
+        symbols = words[word_id]
+        offset = 0
+        for a, b in zip(symbols, symbols[1:]):
+            if (a, b) == pair:
+                return word_id, offset
+            offset += len(id2sym[a])
+
+    def push_pair(self, heap, pair, words, pair_counts, pair_to_words, id2sym):
+        """
+        Push the current state of pair onto the max-heap of pair counts
+        """
+
+        word_id, offset = self.first_occurrence(pair, words, pair_to_words, id2sym)
+        heapq.heappush(heap, (-pair_counts[pair], word_id, offset, pair))
+
+    def select_pair(self, heap, words, pair_counts, pair_to_words, id2sym):
+        """
+        Pop the most frequent pair off the heap. Ties go to the pair seen first when
+        reading the words in order, which is the pair a full recount with count_pairs
+        would pick.
+
+        Entries are never removed when a pair changes, a new one is pushed instead,
+        so outdated entries are skipped here.
+        """
+
+        while heap:
+            count, word_id, offset, pair = heapq.heappop(heap)
+            if pair_counts.get(pair) != -count:
+                continue
+            if (word_id, offset) == self.first_occurrence(
+                pair, words, pair_to_words, id2sym
+            ):
+                return pair
+
     def perform_BPE(self, num_merges):
 
         vocab = self.split_into_words_and_create_vocab()
         # Create the base vocab of all symbols and progressively add to it
         self.vocab = self.create_vocab(vocab)
+        # Learned merges, in the order they were made
+        self.merges = []
+
+        # Merges only ever touch the words containing the merged pair, so rather than
+        # recounting every pair after each merge, keep the pair counts and an index of
+        # pair -> word ids around and only update the words that changed.
+        # Symbols are interned to ints so all of this hashes ints instead of strings.
+        sym2id = {}
+        id2sym = []
+
+        def intern(symbol):
+            if symbol not in sym2id:
+                sym2id[symbol] = len(id2sym)
+                id2sym.append(symbol)
+            return sym2id[symbol]
+
+        words = [[intern(symbol) for symbol in word] for word in vocab]
+        freqs = list(vocab.values())
+
+        pair_counts = collections.defaultdict(int)
+        pair_to_words = collections.defaultdict(set)
+        for word_id, symbols in enumerate(words):
+            self.update_pair_counts(
+                word_id, [], symbols, freqs[word_id], pair_counts, pair_to_words
+            )
+
+        heap = []
+        for pair in pair_counts:
+            self.push_pair(heap, pair, words, pair_counts, pair_to_words, id2sym)
 
         for i in tqdm(range(num_merges)):
-            pairs_pattern = self.count_pairs(vocab)
-            vocab, pattern = self.perform_merge(vocab, pairs_pattern)
+            if len(pair_counts) == 0:
+                break
+
+            pair = self.select_pair(heap, words, pair_counts, pair_to_words, id2sym)
+            pattern_A, pattern_B = pair
+            pattern = id2sym[pattern_A] + id2sym[pattern_B]
+            # Two different pairs can produce the same string, e.g. ('a', 'bc') and ('ab', 'c')
+            existing_pattern = pattern in sym2id
+            pattern_id = intern(pattern)
+
+            changed = set()
+            for word_id in list(pair_to_words[pair]):
+                merged = self.merge_symbols(words[word_id], pair, pattern_id)
+                changed.update(
+                    self.update_pair_counts(
+                        word_id,
+                        words[word_id],
+                        merged,
+                        freqs[word_id],
+                        pair_counts,
+                        pair_to_words,
+                    )
+                )
+                if existing_pattern:
+                    # Pairs with an existing symbol can move without their count changing
+                    changed.update(
+                        (a, b)
+                        for a, b in zip(merged, merged[1:])
+                        if pattern_id in (a, b)
+                    )
+                words[word_id] = merged
 
-            if pattern is not None:
-                self.vocab.append(pattern)
+            for changed_pair in changed:
+                if changed_pair in pair_counts:
+                    self.push_pair(
+                        heap, changed_pair, words, pair_counts, pair_to_words, id2sym
+                    )
+
+            self.vocab.append(pattern)
+            self.merges.append((id2sym[pattern_A], id2sym[pattern_B]))
 
         self.vocab += [self.UNK_TOKEN, self.PAD_TOKEN]
-        return vocab
+        return {
+            tuple(id2sym[symbol] for symbol in symbols): freq
+            for symbols, freq in zip(words, freqs)
+        }
 
     def create_vocab(self, bpe_vocab):
-        vocab = []
 
-        for word, _ in bpe_vocab.items():
-            for token in word.split():
-                vocab.append(token)
-
-        return list(set(vocab))
+        return list({token for word in bpe_vocab for token in word})
 
     def create_tokenization(self, vocab, save_tokenization=True):
 
@@ -154,9 +327,10 @@ class BytePairEncoding:
 
         stoi = {vocab[i]: i for i in range(len(vocab))}
 
+        # Saved as a plain list (index = id) plus the merges, no key conversion on load
         if save_tokenization:
             with open("saved_tokenizations/tokenization.json", "w") as j:
-                json.dump(itos, j, indent=4)
+                json.dump({"vocab": vocab, "merges": self.merges}, j)
         return stoi, itos
 
     def load_tokenization(self, tokenization_path):
@@ -164,11 +338,24 @@ class BytePairEncoding:
         with open(tokenization_path, "r") as f:
             saved_dict = json.load(f)
 
-        self.itos = {int(k): v for k, v in saved_dict.items()}
+        if "vocab" in saved_dict:
+            self.vocab = saved_dict["vocab"]
+            self.merges = [tuple(merge) for merge in saved_dict["merges"]]
+
+            self.itos = dict(enumerate(self.vocab))
 
-        self.stoi = {v: int(k) for k, v in saved_dict.items()}
+            self.stoi = {v: i for i, v in enumerate(self.vocab)}
 
-        self.vocab = list(saved_dict.values())
+        else:
+            # Older tokenizations are a {"id": token} dict without merges
+            self.itos = {int(k): v for k, v in saved_dict.items()}
+
+            self.stoi = {v: int(k) for k, v in saved_dict.items()}
+
+            self.vocab = list(saved_dict.values())
+            self.merges = []
+
+        self.create_token_ranks()
 
     def create_vocab_and_tokenization(self, num_merges):
         BPE_vocab = self.perform_BPE(num_merges=num_merges)
@@ -177,6 +364,115 @@ class BytePairEncoding:
 
         self.stoi = tokens_stoi
         self.itos = tokens_itos
+        self.create_token_ranks()
+
+    def create_token_ranks(self):
+        """
+        Index every token, longest first, by the run of symbols it replaces so tokenize
+        doesn't have to rebuild it on every call.
+        Single-symbol tokens never change a word so they are left out.
+        """
+
+        self.token_ranks = {}
+        for token in sorted(self.vocab, key=len, reverse=True):
+            symbols = self.token_symbols(token)
+            if len(symbols) > 1:
+                self.token_ranks.setdefault(symbols, (len(self.token_ranks), token))
+
+        self.max_run = max(map(len, self.token_ranks), default=0)
+
+        # Rank of every learned merge. Empty for tokenizations saved without merges
+        self.merge_ranks = {}
+        for rank, pair in enumerate(self.merges):
+            self.merge_ranks.setdefault(pair, rank)
+
+    def token_symbols(self, token):
+        """
+        Split a token into the symbols of an unmerged word it covers.
+
+        Ex:
+        >>> print(token_symbols('mathbb</w>'))
+        ('m', 'a', 't', 'h', 'b', 'b', '</w>')
+        """
+
+        head, eow, _ = token.partition(self.EOW_TOKEN)
+
+        return tuple(head) + ((eow,) if eow else ())
+
+    def replace_run(self, symbols, run, token):
+        """
+        Replace every occurrence of a run of symbols with token, scanning left to right
+        """
+
+        replaced = []
+        idx = 0
+        while idx < len(symbols):
+            if symbols[idx] == run[0] and tuple(symbols[idx : idx + len(run)]) == run:
+                replaced.append(token)
+                idx += len(run)
+            else:
+                replaced.append(symbols[idx])
+                idx += 1
+
+        return replaced
+
+    def encode_word(self, word):
+        """
+        Split a word into tokens.
+
+        With learned merges these are replayed on the word, otherwise (tokenizations
+        saved without merges) every token is substituted, longest first.
+        """
+
+        symbols = list(word) + [self.EOW_TOKEN]
+
+        if self.merge_ranks:
+            return self.apply_merges(symbols)
+
+        return self.substitute_tokens(symbols)
+
+    def apply_merges(self, symbols):
+        """
+        Repeatedly merge the adjacent pair that was learned first until no learned pair
+        is left. Words seen in training get the same split they had at the end of it.
+
+        Ex:
+        >>> merges = [('i', 's'), ('is', '</w>'), ('t', 'h')]
+        >>> print(apply_merges(['t', 'h', 'i', 's', '</w>']))
+        ['th', 'is</w>']
+        """
+
+        while len(symbols) > 1:
+            pair = min(
+                zip(symbols, symbols[1:]),
+                key=lambda pair: self.merge_ranks.get(pair, len(self.merge_ranks)),
+            )
+            if pair not in self.merge_ranks:
+                break
+
+            symbols = self.merge_symbols(symbols, pair)
+
+        return symbols
+
+    def substitute_tokens(self, symbols):
+        """
+        Split a word into tokens by substituting every token, longest first.
+
+        Tokens only ever match runs of the original, unmerged symbols, so rather
+        than trying the whole vocab only the tokens found in the word are applied.
+        """
+
+        candidates = {}
+        for start in range(len(symbols)):
+            for end in range(start + 2, min(start + self.max_run, len(symbols)) + 1):
+                run = tuple(symbols[start:end])
+                if run in self.token_ranks:
+                    candidates[run] = self.token_ranks[run]
+
+        for run, (_, token) in sorted(candidates.items(), key=lambda x: x[1]):
+            symbols = self.replace_run(symbols, run, token)
+
+        return symbols
 
     def tokenize(self, string_to_tokenize):
 
@@ -184,46 +480,25 @@ class BytePairEncoding:
             self.stoi is not None and self.itos is not None
         ), "Requires tokenization of base corpus first."
 
-        # Split string into characters and apply merge rules
+        # Split string into words and apply merge rules
 
-        split_chars = []
-        for word in nltk.wordpunct_tokenize(
+        split_words = _WORDPUNCT_RE.findall(
             string_to_tokenize.lower() if self.lower_case else string_to_tokenize
-        ):
-            split_chars.append(" ".join(list(word) + [self.EOW_TOKEN]))
+        )
 
         word_tokenization = []
+        encoded_words = {}
 
-        for word in tqdm(split_chars):
-            for token in sorted(self.vocab, key=len, reverse=True):
-                # Splits BPE tokens like 'mathbb</w>' -> ['mathbb', '</w>', '']
-                split_tok = re.split(f"({self.EOW_TOKEN})", token)
-                if len(split_tok) > 1:
-                    pattern = " ".join(list(split_tok[0]) + [split_tok[1]])
-                else:
-                    pattern = " ".join(list(split_tok[0]))
-
-                # ugh.
-                if pattern == "\\":
-                    word = re.sub(
-                        r"(?<!\S)" + re.escape(pattern) + r"(?!\S)",
-                        repl=re.escape(token),
-                        string=word,
-                    )
-                else:
-                    word = re.sub(
-                        r"(?<!\S)" + re.escape(pattern) + r"(?!\S)",
-                        repl=token,
-                        string=word,
-                    )
-            word_tokenization += word.split()
-
-        # Replace unknown tokens with UNK TOKEN
-        word_tokenization = [
-            i if i in self.stoi.keys() else self.UNK_TOKEN for i in word_tokenization
-        ]
-        
-        return Tokenization(word_tokenization, [self.stoi[i] for i in word_tokenization] )
+        for word in split_words:
+            if word not in encoded_words:
+                encoded_words[word] = self.encode_word(word)
+            word_tokenization += encoded_words[word]
+
+        # Replace unknown tokens with UNK TOKEN, looking every token up only once
+        unk_id = self.stoi[self.UNK_TOKEN]
+        converted_tokens = [self.stoi.get(i, unk_id) for i in word_tokenization]
+
+        return Tokenization([self.itos[i] for i in converted_tokens], converted_tokens)
 
     def tokens_to_str(self, tokens):
         """
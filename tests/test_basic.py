@@ -11,24 +11,24 @@ class TestBPEBasic(unittest.TestCase):
 
     def test_split_into_words_and_create_vocab(self):
         vocab_expected = {
-            "t h i s </w>": 1,
-            "i s </w>": 1,
-            "a </w>": 1,
-            "t e s t </w>": 1,
-            "s t r i n g </w>": 1,
-            "! </w>": 1,
+            ("t", "h", "i", "s", "</w>"): 1,
+            ("i", "s", "</w>"): 1,
+            ("a", "</w>"): 1,
+            ("t", "e", "s", "t", "</w>"): 1,
+            ("s", "t", "r", "i", "n", "g", "</w>"): 1,
+            ("!", "</w>"): 1,
         }
 
         self.assertEqual(vocab_expected, self.bpe.split_into_words_and_create_vocab())
 
     def test_count_pairs(self):
         vocab = {
-            "t h i s </w>": 1,
-            "i s </w>": 1,
-            "a </w>": 1,
-            "t e s t </w>": 1,
-            "s t r i n g </w>": 1,
-            "! </w>": 1,
+            ("t", "h", "i", "s", "</w>"): 1,
+            ("i", "s", "</w>"): 1,
+            ("a", "</w>"): 1,
+            ("t", "e", "s", "t", "</w>"): 1,
+            ("s", "t", "r", "i", "n", "g", "</w>"): 1,
+            ("!", "</w>"): 1,
         }
         pairs_expected = {
             ("i", "s"): 2,
@@ -53,12 +53,12 @@ class TestBPEBasic(unittest.TestCase):
 
     def test_perform_merge(self):
         vocab = {
-            "t h i s </w>": 1,
-            "i s </w>": 1,
-            "a </w>": 1,
-            "t e s t </w>": 1,
-            "s t r i n g </w>": 1,
-            "! </w>": 1,
+            ("t", "h", "i", "s", "</w>"): 1,
+            ("i", "s", "</w>"): 1,
+            ("a", "</w>"): 1,
+            ("t", "e", "s", "t", "</w>"): 1,
+            ("s", "t", "r", "i", "n", "g", "</w>"): 1,
+            ("!", "</w>"): 1,
         }
         pairs_pattern = {
             ("i", "s"): 2,
@@ -79,12 +79,12 @@ class TestBPEBasic(unittest.TestCase):
         }
 
         merged_vocab_expected = {
-            "t h is </w>": 1,
-            "is </w>": 1,
-            "a </w>": 1,
-            "t e s t </w>": 1,
-            "s t r i n g </w>": 1,
-            "! </w>": 1,
+            ("t", "h", "is", "</w>"): 1,
+            ("is", "</w>"): 1,
+            ("a", "</w>"): 1,
+            ("t", "e", "s", "t", "</w>"): 1,
+            ("s", "t", "r", "i", "n", "g", "</w>"): 1,
+            ("!", "</w>"): 1,
         }
 
         merged_vocab, _ = self.bpe.perform_merge(vocab, pairs_pattern)
@@ -107,6 +107,30 @@ class TestBPECased(unittest.TestCase):
 
         self.assertEqual(set(expected_vocab), set(self.bpe.vocab))
 
+    def test_save_and_load_tokenization(self):
+        self.bpe.create_vocab_and_tokenization(num_merges=250)
+        vocab, merges = self.bpe.vocab, self.bpe.merges
+        stoi, itos = self.bpe.stoi, self.bpe.itos
+
+        self.bpe.load_tokenization(r"saved_tokenizations\tokenization.json")
+
+        self.assertEqual(vocab, self.bpe.vocab)
+        self.assertEqual(merges, self.bpe.merges)
+        self.assertEqual(stoi, self.bpe.stoi)
+        self.assertEqual(itos, self.bpe.itos)
+
+    def test_tokenize_with_merges_cased(self):
+        # Words from the corpus should be split the same way they were in training
+        bpe_vocab = self.bpe.perform_BPE(num_merges=250)
+        self.bpe.stoi, self.bpe.itos = self.bpe.create_tokenization(
+            self.bpe.vocab, save_tokenization=False
+        )
+        self.bpe.create_token_ranks()
+
+        for word in bpe_vocab:
+            string = "".join(word)[: -len(self.bpe.EOW_TOKEN)]
+            self.assertEqual(list(word), self.bpe.tokenize(string).tokens)
+
     def test_tokenize_cased(self):
         self.bpe.load_tokenization(r"tests\data\tokenizations\tokenization_cased.json")
 